@@ -1,7 +1,7 @@
 """
 models.py — Schemas Pydantic para validación de datos
 """
-from pydantic import BaseModel, EmailStr
+from pydantic import BaseModel
 from typing import Optional, List
 from datetime import datetime
 
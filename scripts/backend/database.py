@@ -3,177 +3,293 @@ database.py — Acceso a Supabase via API REST (postgrest-py)
 Usamos httpx directamente para máxima compatibilidad con Python 3.14+
 """
 import os
+import asyncio
+import logging
 import httpx
+import orjson
+from cachetools import TTLCache
 from dotenv import load_dotenv
-from datetime import datetime, timezone
-from typing import Optional, List, Dict, Any, Tuple
+from datetime import datetime
+from uuid import UUID
+from typing import Optional, Dict, Any, Tuple
 
 load_dotenv()
 
+logger = logging.getLogger(__name__)
+
 SUPABASE_URL      = os.getenv("SUPABASE_URL", "")
 SUPABASE_KEY      = os.getenv("SUPABASE_SERVICE_KEY", "")
 
-def _headers() -> Dict[str, str]:
-    return {
-        "apikey":        SUPABASE_KEY,
-        "Authorization": f"Bearer {SUPABASE_KEY}",
-        "Content-Type":  "application/json",
-        "Prefer":        "return=representation",
-    }
+# Cliente compartido (pool de conexiones a Supabase). Se crea y se cierra en el
+# lifespan de la app para no pagar un handshake TCP+TLS por cada consulta;
+# _get_client lo crea al primer uso si la app se sirve sin lifespan.
+_client: Optional[httpx.AsyncClient] = None
+
+
+def _get_client() -> httpx.AsyncClient:
+    global _client
+    if _client is None:
+        _client = httpx.AsyncClient(
+            timeout=15,
+            http2=True,
+            limits=httpx.Limits(max_keepalive_connections=20, max_connections=100),
+        )
+    return _client
+
+
+async def init_client() -> None:
+    _get_client()
+
+
+# Timeout corto: si la red hacia el servicio está lenta o bloqueada, el worker
+# no debe demorar su arranque; la primera petición real abrirá la conexión.
+_WARM_UP_TIMEOUT = 2.0
+
+
+async def warm_up() -> None:
+    """Abre la conexión TLS con Supabase antes de la primera petición real."""
+    if not SUPABASE_URL:
+        return
+    try:
+        await _get_client().head(f"{_REST_URL}/", headers=_HEADERS, timeout=_WARM_UP_TIMEOUT)
+    except httpx.HTTPError:
+        pass
+
+
+async def close_client() -> None:
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
 
-def _url(table: str, query: str = "") -> str:
-    base = f"{SUPABASE_URL}/rest/v1/{table}"
-    return f"{base}?{query}" if query else base
 
-def _now() -> str:
-    return datetime.now(timezone.utc).isoformat()
+# Headers y URLs precalculados una sola vez al importar (no por llamada)
+_BASE_HEADERS: Dict[str, str] = {
+    "apikey":        SUPABASE_KEY,
+    "Authorization": f"Bearer {SUPABASE_KEY}",
+    "Content-Type":  "application/json",
+    "Prefer":        "return=representation",
+}
+_HEADERS         = httpx.Headers(_BASE_HEADERS)
+_HEADERS_MERGE   = httpx.Headers({**_BASE_HEADERS, "Prefer": "resolution=merge-duplicates,return=representation"})
+_HEADERS_IGNORE  = httpx.Headers({**_BASE_HEADERS, "Prefer": "resolution=ignore-duplicates,return=representation"})
+_HEADERS_COUNT   = httpx.Headers({**_BASE_HEADERS, "Prefer": "count=exact"})
+
+_REST_URL = f"{SUPABASE_URL}/rest/v1"
+_TABLE_URLS: Dict[str, str] = {
+    table: f"{_REST_URL}/{table}" for table in ("customers", "orders", "whatsapp_logs")
+}
+_RPC_LOG_WHATSAPP_URL = f"{_REST_URL}/rpc/log_whatsapp_result"
+
+# Cache en proceso (por worker) del detalle de pedidos. Se invalida al
+# cambiar estado o registrar WhatsApp; el TTL corto acota la desactualización
+# entre workers. Un miss hace get → await fetch → set: si una escritura invalida
+# el pedido durante ese await, la fila leída ya es vieja. Cada invalidación sube
+# la generación del pedido y el set se omite si cambió mientras se consultaba.
+# (_order_cache_gen guarda un int por pedido modificado en la vida del worker.)
+_order_cache: TTLCache = TTLCache(maxsize=1024, ttl=30)
+_order_cache_gen: Dict[str, int] = {}
+
+
+def _evict_order(order_id: str) -> None:
+    _order_cache.pop(order_id, None)
+    _order_cache_gen[order_id] = _order_cache_gen.get(order_id, 0) + 1
 
 
 # ────────────────────────────────────────────────────
 # Clientes
 # ────────────────────────────────────────────────────
 
-def upsert_customer(customer_data: Dict[str, Any]) -> Dict[str, Any]:
+async def upsert_customer(customer_data: Dict[str, Any]) -> Dict[str, Any]:
     email = customer_data.get("email")
     name  = customer_data.get("name", "Sin nombre")
     phone = customer_data.get("phone")
 
-    with httpx.Client(timeout=15) as c:
-        if email:
-            # Buscar cliente existente por email
-            r = c.get(_url("customers", f"email=eq.{email}&select=*"), headers=_headers())
-            if r.status_code == 200 and r.json():
-                existing = r.json()[0]
-                update: Dict[str, Any] = {"updated_at": _now()}
-                if name: update["name"] = name
-                if phone: update["phone"] = phone
-                c.patch(
-                    _url("customers", f"email=eq.{email}"),
-                    headers=_headers(), json=update
-                )
-                return {**existing, **update}
-
-        # Insertar
-        body: Dict[str, Any] = {"name": name, "created_at": _now(), "updated_at": _now()}
-        if email: body["email"] = email
-        if phone: body["phone"] = phone
-        r = c.post(_url("customers"), headers=_headers(), json=body)
-        return r.json()[0] if r.json() else {}
+    # Upsert nativo de PostgREST: una sola llamada, sin carrera entre pedidos
+    # concurrentes del mismo email. Solo se envían los campos con valor para
+    # no pisar datos existentes con null.
+    body: Dict[str, Any] = {"name": name}
+    if email: body["email"] = email
+    if phone: body["phone"] = phone
+    r = await _get_client().post(
+        _TABLE_URLS["customers"],
+        params={"on_conflict": "email"},
+        headers=_HEADERS_MERGE,
+        content=orjson.dumps(body),
+    )
+    rows = orjson.loads(r.content)
+    return rows[0] if rows else {}
 
 
 # ────────────────────────────────────────────────────
 # Pedidos
 # ────────────────────────────────────────────────────
 
-def upsert_order(order_data: Dict[str, Any]) -> Tuple[Dict[str, Any], bool]:
+async def upsert_order(order_data: Dict[str, Any]) -> Tuple[Dict[str, Any], bool]:
     """Retorna (pedido, es_nuevo)."""
     shopify_id = order_data["shopify_order_id"]
-    with httpx.Client(timeout=15) as c:
-        # Verificar idempotencia
-        r = c.get(
-            _url("orders", f"shopify_order_id=eq.{shopify_id}&select=id,shopify_order_id"),
-            headers=_headers()
-        )
-        if r.status_code == 200 and r.json():
-            return r.json()[0], False
+    # Insertar ignorando duplicados: si el pedido ya existe PostgREST no
+    # devuelve filas, y solo en ese caso (reintentos de Make) se consulta el id.
+    # created_at/updated_at los pone Postgres (DEFAULT NOW()).
+    r = await _get_client().post(
+        _TABLE_URLS["orders"],
+        params={"on_conflict": "shopify_order_id"},
+        headers=_HEADERS_IGNORE,
+        content=orjson.dumps(order_data),
+    )
+    # Cualquier error del INSERT se propaga (500): Make reintenta y el pedido
+    # no se pierde. Solo un 2xx sin filas significa "ya existía".
+    r.raise_for_status()
+    rows = orjson.loads(r.content) if r.content else []
+    if rows:
+        return rows[0], True
 
-        # Insertar
-        order_data["created_at"] = _now()
-        order_data["updated_at"] = _now()
-        r = c.post(_url("orders"), headers=_headers(), json=order_data)
-        return (r.json()[0] if r.json() else {}), True
+    # Ya existía (idempotencia)
+    r = await _get_client().get(
+        _TABLE_URLS["orders"],
+        params={"shopify_order_id": f"eq.{shopify_id}", "select": "id,shopify_order_id"},
+        headers=_HEADERS
+    )
+    rows = orjson.loads(r.content) if r.status_code == 200 else []
+    return (rows[0] if rows else {}), False
 
 
-def get_orders(
+async def get_orders(
     status: Optional[str] = None,
     whatsapp_sent: Optional[bool] = None,
     limit: int = 50,
-    offset: int = 0,
-) -> List[Dict[str, Any]]:
-    parts = ["select=*", f"limit={limit}", f"offset={offset}", "order=created_at.desc"]
+    cursor_created_at: Optional[datetime] = None,
+    cursor_id: Optional[UUID] = None,
+) -> Dict[str, Any]:
+    """
+    Paginación por keyset (created_at, id): cada página cuesta lo mismo sin
+    importar la profundidad, a diferencia de offset. Retorna
+    {"orders": [...], "next_cursor": {"created_at", "id"} | None}.
+    """
+    params: Dict[str, str] = {
+        "select": "*",
+        "limit":  str(limit),
+        "order":  "created_at.desc,id.desc",
+    }
     if status:
-        parts.append(f"status=eq.{status}")
+        params["status"] = f"eq.{status}"
     if whatsapp_sent is not None:
         val = "true" if whatsapp_sent else "false"
-        parts.append(f"whatsapp_sent=eq.{val}")
-    query = "&".join(parts)
-    with httpx.Client(timeout=15) as c:
-        r = c.get(_url("orders", query), headers=_headers())
-        return r.json() if r.status_code == 200 else []
-
-
-def get_order_by_id(order_id: str) -> Optional[Dict[str, Any]]:
-    with httpx.Client(timeout=15) as c:
-        # Obtener pedido
-        r = c.get(_url("orders", f"id=eq.{order_id}&select=*"), headers=_headers())
-        if not r.json():
-            return None
-        order = r.json()[0]
-        # Obtener logs de WhatsApp
-        r2 = c.get(
-            _url("whatsapp_logs", f"order_id=eq.{order_id}&select=*&order=sent_at.desc"),
-            headers=_headers()
+        params["whatsapp_sent"] = f"eq.{val}"
+    if cursor_created_at is not None and cursor_id is not None:
+        # Valores entre comillas: el timestamp contiene '.' y ':' (reservados en or=).
+        # Al ser datetime / UUID ya parseados no pueden traer '"' ni ',' propios.
+        ts = cursor_created_at.isoformat()
+        params["or"] = (
+            f'(created_at.lt."{ts}",'
+            f'and(created_at.eq."{ts}",id.lt."{cursor_id}"))'
         )
-        order["whatsapp_logs"] = r2.json() if r2.status_code == 200 else []
-        return order
+    r = await _get_client().get(_TABLE_URLS["orders"], params=params, headers=_HEADERS)
+    rows = orjson.loads(r.content) if r.status_code == 200 else []
 
+    next_cursor = None
+    if len(rows) == limit:
+        last = rows[-1]
+        next_cursor = {"created_at": last["created_at"], "id": last["id"]}
+    return {"orders": rows, "next_cursor": next_cursor}
 
-def update_order_status(
+
+async def get_order_by_id(order_id: str) -> Optional[Dict[str, Any]]:
+    cached = _order_cache.get(order_id)
+    if cached is not None:
+        return cached
+    gen = _order_cache_gen.get(order_id, 0)
+
+    # Pedido + logs de WhatsApp en una sola consulta (embedding por FK de PostgREST)
+    r = await _get_client().get(
+        _TABLE_URLS["orders"],
+        params={
+            "id": f"eq.{order_id}",
+            "select": "*,whatsapp_logs(*)",
+            "whatsapp_logs.order": "sent_at.desc",
+        },
+        headers=_HEADERS
+    )
+    rows = orjson.loads(r.content) if r.status_code == 200 else []
+    if not rows:
+        return None
+    order = rows[0]
+    order["whatsapp_logs"] = order.get("whatsapp_logs") or []
+    if _order_cache_gen.get(order_id, 0) == gen:
+        _order_cache[order_id] = order
+    return order
+
+
+async def update_order_status(
     order_id: str, status: str, notes: Optional[str] = None
 ) -> Dict[str, Any]:
-    body: Dict[str, Any] = {"status": status, "updated_at": _now()}
+    # updated_at lo actualiza el trigger trigger_orders_updated_at
+    body: Dict[str, Any] = {"status": status}
     if notes is not None:
         body["notes"] = notes
-    with httpx.Client(timeout=15) as c:
-        r = c.patch(
-            _url("orders", f"id=eq.{order_id}"),
-            headers=_headers(), json=body
-        )
-        return r.json()[0] if r.json() else {}
+    r = await _get_client().patch(
+        _TABLE_URLS["orders"],
+        params={"id": f"eq.{order_id}"},
+        headers=_HEADERS, content=orjson.dumps(body)
+    )
+    _evict_order(order_id)
+    rows = orjson.loads(r.content)
+    return rows[0] if rows else {}
 
 
-def mark_whatsapp_sent(
+async def mark_whatsapp_sent(
     order_id: str,
     success: bool,
     message_id: Optional[str] = None,
     error: Optional[str] = None,
 ):
-    with httpx.Client(timeout=15) as c:
-        # Actualizar pedido
-        update: Dict[str, Any] = {"whatsapp_sent": success, "updated_at": _now()}
-        if success:
-            update["whatsapp_sent_at"] = _now()
-        c.patch(_url("orders", f"id=eq.{order_id}"), headers=_headers(), json=update)
-
-        # Insertar log
-        log: Dict[str, Any] = {
-            "order_id":    order_id,
-            "success":     success,
-            "message_id":  message_id,
-            "error_message": error,
-            "sent_at":     _now(),
-        }
-        c.post(_url("whatsapp_logs"), headers=_headers(), json=log)
+    # Update del pedido + insert del log en una sola llamada (función SQL
+    # log_whatsapp_result, ver supabase_schema.sql). Los timestamps los pone Postgres.
+    r = await _get_client().post(
+        _RPC_LOG_WHATSAPP_URL,
+        headers=_HEADERS,
+        content=orjson.dumps({
+            "p_order_id":   order_id,
+            "p_success":    success,
+            "p_message_id": message_id,
+            "p_error":      error,
+        }),
+    )
+    _evict_order(order_id)
+    if r.is_error:
+        # Sin lanzar: el WhatsApp ya se envió (o falló) y el llamador no debe
+        # caerse por el registro, pero el resultado no puede perderse en silencio
+        # (p. ej. 404 si la función SQL aún no está desplegada).
+        logger.error(
+            f"❌ No se pudo registrar el WhatsApp del pedido {order_id} "
+            f"(success={success}, message_id={message_id}, error={error}): "
+            f"HTTP {r.status_code} {r.text}"
+        )
 
 
 # ────────────────────────────────────────────────────
 # Stats
 # ────────────────────────────────────────────────────
 
-def get_dashboard_stats() -> Dict[str, Any]:
-    h = {**_headers(), "Prefer": "count=exact"}
-    with httpx.Client(timeout=15) as c:
-        total   = c.get(_url("orders", "select=id"), headers=h)
-        nuevos  = c.get(_url("orders", "status=eq.nuevo&select=id"), headers=h)
-        enviado = c.get(_url("orders", "status=eq.enviado&select=id"), headers=h)
-        sin_wsp = c.get(_url("orders", "whatsapp_sent=eq.false&select=id"), headers=h)
+async def get_dashboard_stats() -> Dict[str, Any]:
+    # HEAD + count=exact: PostgREST solo devuelve el total en Content-Range,
+    # sin filas. Las cuatro consultas van en paralelo (1 RTT en vez de 4).
+    url = _TABLE_URLS["orders"]
+    h = _HEADERS_COUNT
+    client = _get_client()
+    total, nuevos, enviado, sin_wsp = await asyncio.gather(
+        client.head(url, params={"select": "id"}, headers=h),
+        client.head(url, params={"status": "eq.nuevo", "select": "id"}, headers=h),
+        client.head(url, params={"status": "eq.enviado", "select": "id"}, headers=h),
+        client.head(url, params={"whatsapp_sent": "eq.false", "select": "id"}, headers=h),
+    )
 
     def count(r: httpx.Response) -> int:
         cr = r.headers.get("content-range", "")
         if cr and "/" in cr:
             try: return int(cr.split("/")[1])
             except: pass
-        try: return len(r.json())
+        try: return len(orjson.loads(r.content))
         except: return 0
 
     return {
@@ -11,13 +11,30 @@ Endpoints:
   GET  /health               — Health check
 """
 import os
-from fastapi import FastAPI, HTTPException, Header, Depends, Query
+import time
+import asyncio
+import hashlib
+import orjson
+from datetime import datetime
+from uuid import UUID
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, HTTPException, Header, Depends, Query, BackgroundTasks, Request, Response
+from fastapi.exceptions import RequestValidationError
+from fastapi.responses import JSONResponse
+from pydantic import TypeAdapter, ValidationError
 from fastapi.middleware.cors import CORSMiddleware
 from dotenv import load_dotenv
 from typing import Optional, List
 import logging
 
-from models import ShopifyOrderPayload, OrderStatusUpdate
+from models import (
+    ShopifyOrderPayload,
+    OrderStatusUpdate,
+    make_order_filter,
+    SHOPIFY_ORDER_ADAPTER,
+    ORDER_STATUS_ADAPTER,
+    EMPTY_SHIPPING,
+)
 from database import (
     upsert_customer,
     upsert_order,
@@ -26,8 +43,16 @@ from database import (
     update_order_status,
     mark_whatsapp_sent,
     get_dashboard_stats,
+    init_client as init_db_client,
+    close_client as close_db_client,
+    warm_up as warm_up_db,
+)
+from whatsapp_service import (
+    send_order_confirmation,
+    init_client as init_whatsapp_client,
+    close_client as close_whatsapp_client,
+    warm_up as warm_up_whatsapp,
 )
-from whatsapp_service import send_order_confirmation
 
 load_dotenv()
 
@@ -39,13 +64,80 @@ logger = logging.getLogger(__name__)
 
 WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET_TOKEN", "")
 CORS_ORIGINS = os.getenv("CORS_ORIGINS", "http://localhost:5173").split(",")
+# Prefijo bajo el que se publica la API (p. ej. "/api" en Vercel, ver api/index.py)
+API_ROOT_PATH = os.getenv("API_ROOT_PATH", "")
+
+
+class OrjsonResponse(JSONResponse):
+    """
+    JSONResponse serializada con orjson. Reemplaza a fastapi.responses.ORJSONResponse,
+    deprecada en FastAPI reciente (avisa en cada instancia): su alternativa
+    (serializar con Pydantic) solo aplica con response_model, y estos
+    endpoints devuelven dicts de Supabase sin modelo.
+    """
+
+    def render(self, content) -> bytes:
+        return orjson.dumps(content, option=orjson.OPT_NON_STR_KEYS)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """
+    Ciclo de vida de la app: abre los clientes HTTP compartidos y los calienta
+    (TLS ya establecido antes de la primera petición); los libera al apagar.
+    """
+    await init_db_client()
+    await init_whatsapp_client()
+    await asyncio.gather(warm_up_db(), warm_up_whatsapp())
+    yield
+    await close_db_client()
+    await close_whatsapp_client()
+
 
 app = FastAPI(
     title="COPAS CRM API",
     description="CRM de pedidos Shopify con integración WhatsApp",
     version="1.0.0",
+    docs_url=f"{API_ROOT_PATH}/docs",
+    openapi_url=f"{API_ROOT_PATH}/openapi.json",
+    servers=[{"url": API_ROOT_PATH}] if API_ROOT_PATH else None,
+    lifespan=lifespan,
+    default_response_class=OrjsonResponse,
 )
 
+class LogRequestsMiddleware:
+    """
+    Middleware ASGI puro que registra método, ruta, status y duración.
+    Evita BaseHTTPMiddleware (@app.middleware("http")), que construye
+    Request/Response y re-empaqueta el body en cada petición.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            # websocket / lifespan pasan sin cambios
+            await self.app(scope, receive, send)
+            return
+
+        start = time.perf_counter()
+        status_code = 500
+
+        async def send_wrapper(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            elapsed_ms = (time.perf_counter() - start) * 1000
+            logger.info(f"{scope['method']} {scope['path']} → {status_code} ({elapsed_ms:.1f} ms)")
+
+
+app.add_middleware(LogRequestsMiddleware)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=CORS_ORIGINS,
@@ -69,6 +161,88 @@ def verify_webhook_token(x_webhook_token: Optional[str] = Header(None)):
     return True
 
 
+# ────────────────────────────────────────────────────
+# Validación del body desde bytes crudos
+# ────────────────────────────────────────────────────
+async def validate_body(request: Request, adapter: TypeAdapter):
+    """
+    Valida el body crudo con adapter.validate_json: pydantic-core parsea el
+    JSON y valida en una sola pasada, sin dict intermedio de json.loads.
+    Los errores se devuelven como el 422 estándar de FastAPI (loc con "body").
+    """
+    try:
+        return adapter.validate_json(await request.body())
+    except ValidationError as e:
+        raise RequestValidationError(
+            [{**err, "loc": ("body", *err["loc"])} for err in e.errors(include_url=False)]
+        )
+
+
+# Sub-modelos de los bodies documentados con _json_body_schema; se registran
+# en components.schemas al generar el OpenAPI (ver _openapi).
+_BODY_SCHEMA_DEFS: dict = {}
+
+
+def _json_body_schema(model) -> dict:
+    """openapi_extra para documentar el body de endpoints que leen Request."""
+    # Refs apuntando a components/schemas: "#/$defs/..." no existe en la raíz del OpenAPI
+    schema = model.model_json_schema(ref_template="#/components/schemas/{model}")
+    _BODY_SCHEMA_DEFS.update(schema.pop("$defs", {}))
+    return {
+        "requestBody": {
+            "required": True,
+            "content": {"application/json": {"schema": schema}},
+        }
+    }
+
+
+def _openapi() -> dict:
+    if app.openapi_schema is None:
+        schema = FastAPI.openapi(app)
+        components = schema.setdefault("components", {}).setdefault("schemas", {})
+        for name, definition in _BODY_SCHEMA_DEFS.items():
+            components.setdefault(name, definition)
+    return app.openapi_schema
+
+
+app.openapi = _openapi
+
+
+# ────────────────────────────────────────────────────
+# Caché HTTP: ETag / If-None-Match
+# ────────────────────────────────────────────────────
+def _etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """
+    Comparación débil de If-None-Match (RFC 9110): lista separada por comas,
+    "*" o tags con prefijo W/ (proxies/CDN que comprimen reescriben el ETag).
+    """
+    if not if_none_match:
+        return False
+    for tag in if_none_match.split(","):
+        tag = tag.strip()
+        if tag == "*":
+            return True
+        if tag.startswith("W/"):
+            tag = tag[2:]
+        if tag == etag:
+            return True
+    return False
+
+
+def etag_response(request: Request, payload) -> Response:
+    """
+    Serializa el payload una sola vez y responde 304 si el cliente ya tiene
+    esa misma versión (If-None-Match). El hash cubre todo el body, incluido
+    updated_at, así que cualquier cambio del pedido genera un ETag nuevo.
+    """
+    body = orjson.dumps(payload)
+    etag = f'"{hashlib.blake2b(body, digest_size=8).hexdigest()}"'
+    headers = {"ETag": etag, "Cache-Control": "private, max-age=5"}
+    if _etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=headers)
+    return Response(content=body, media_type="application/json", headers=headers)
+
+
 # ────────────────────────────────────────────────────
 # ENDPOINTS
 # ────────────────────────────────────────────────────
@@ -79,8 +253,12 @@ def health_check():
     return {"status": "ok", "service": "COPAS CRM API"}
 
 
-@app.post("/webhook/shopify", dependencies=[Depends(verify_webhook_token)])
-async def receive_shopify_order(payload: ShopifyOrderPayload):
+@app.post(
+    "/webhook/shopify",
+    dependencies=[Depends(verify_webhook_token)],
+    openapi_extra=_json_body_schema(ShopifyOrderPayload),
+)
+async def receive_shopify_order(request: Request, background_tasks: BackgroundTasks):
     """
     Recibe un pedido de Shopify vía Make.
     
@@ -88,30 +266,29 @@ async def receive_shopify_order(payload: ShopifyOrderPayload):
     1. Extraer datos del cliente
     2. Upsert cliente en Supabase
     3. Upsert pedido (idempotente por shopify_order_id)
-    4. Enviar WhatsApp de confirmación si hay teléfono
+    4. Programar el WhatsApp de confirmación si hay teléfono (en segundo plano)
     5. Retornar confirmación a Make
     """
+    payload = await validate_body(request, SHOPIFY_ORDER_ADAPTER)
+
     logger.info(f"📦 Pedido recibido: {payload.order_number} (Shopify ID: {payload.shopify_order_id})")
 
     # 1. Extraer datos del cliente
-    customer = payload.customer or {}
+    # (customer / shipping_address nunca son None: si faltan son los singletons vacíos)
+    flat = payload.to_flat()
     shipping = payload.shipping_address
 
-    # Nombre del cliente
-    first_name = getattr(customer, "first_name", None) or ""
-    last_name = getattr(customer, "last_name", None) or ""
-    customer_name = f"{first_name} {last_name}".strip() or "Cliente"
+    # Nombre del cliente ("Cliente" si no hay nombre)
+    customer_name = flat.customer_name
 
-    # Email
-    customer_email = getattr(customer, "email", None)
+    # Email ("" → NULL en la base de datos)
+    customer_email = payload.customer.email or None
 
-    # Teléfono: intentar customer.phone primero, luego shipping_address.phone
-    customer_phone = getattr(customer, "phone", None)
-    if not customer_phone and shipping:
-        customer_phone = getattr(shipping, "phone", None)
+    # Teléfono: customer.phone o, si falta, shipping_address.phone
+    customer_phone = flat.phone or None
 
     # 2. Upsert cliente
-    customer_record = upsert_customer({
+    customer_record = await upsert_customer({
         "name": customer_name,
         "email": customer_email,
         "phone": customer_phone,
@@ -119,8 +296,10 @@ async def receive_shopify_order(payload: ShopifyOrderPayload):
     customer_id = customer_record.get("id")
 
     # 3. Preparar datos del pedido
-    line_items_data = [item.model_dump() for item in payload.line_items]
-    shipping_data = shipping.model_dump() if shipping else {}
+    # Una sola pasada del serializador para los campos JSONB
+    dumped = payload.model_dump(mode="json", include={"line_items", "shipping_address"})
+    line_items_data = dumped["line_items"]
+    shipping_data = dumped["shipping_address"] if shipping != EMPTY_SHIPPING else {}
 
     order_data = {
         "shopify_order_id": payload.shopify_order_id,
@@ -131,18 +310,18 @@ async def receive_shopify_order(payload: ShopifyOrderPayload):
         "customer_phone": customer_phone,
         "shipping_address": shipping_data,
         "line_items": line_items_data,
-        "total_price": payload.total_price,
+        "total_price": str(payload.total_price),
         "currency": payload.currency,
         "financial_status": payload.financial_status,
         "fulfillment_status": payload.fulfillment_status,
         "status": "nuevo",
-        "notes": payload.note,
-        "tags": payload.tags,
+        "notes": payload.note or None,
+        "tags": payload.tags or None,
         "whatsapp_sent": False,
     }
 
     # 4. Upsert pedido (idempotente)
-    order_record, is_new = upsert_order(order_data)
+    order_record, is_new = await upsert_order(order_data)
     order_id = order_record.get("id")
 
     if not is_new:
@@ -154,99 +333,146 @@ async def receive_shopify_order(payload: ShopifyOrderPayload):
             "whatsapp_sent": False,
         }
 
-    # 5. Enviar WhatsApp si hay teléfono
-    whatsapp_result = {"success": False, "message_id": None, "error": "Sin teléfono"}
-
+    # 5. Enviar WhatsApp en segundo plano: Make recibe el 200 apenas el pedido
+    #    queda guardado y la latencia de Meta sale del camino crítico.
     if customer_phone:
-        logger.info(f"📱 Enviando WhatsApp a {customer_phone}...")
-        whatsapp_result = send_order_confirmation(
+        background_tasks.add_task(
+            _send_and_log,
+            order_id=order_id,
             phone=customer_phone,
             customer_name=customer_name,
             order_number=payload.order_number,
-            total=payload.total_price,
+            total=str(payload.total_price),
             currency=payload.currency,
         )
-        if whatsapp_result["success"]:
-            logger.info(f"✅ WhatsApp enviado. Message ID: {whatsapp_result['message_id']}")
-        else:
-            logger.warning(f"❌ WhatsApp falló: {whatsapp_result['error']}")
     else:
         logger.warning(f"⚠️ Pedido {payload.order_number} sin teléfono — WhatsApp omitido")
-
-    # Registrar resultado del WhatsApp
-    if order_id:
-        mark_whatsapp_sent(
-            order_id=order_id,
-            success=whatsapp_result["success"],
-            message_id=whatsapp_result.get("message_id"),
-            error=whatsapp_result.get("error"),
-        )
+        if order_id:
+            await mark_whatsapp_sent(order_id=order_id, success=False, error="Sin teléfono")
 
     return {
         "success": True,
         "order_id": order_id,
         "order_number": payload.order_number,
-        "whatsapp_sent": whatsapp_result["success"],
-        "whatsapp_error": whatsapp_result.get("error") if not whatsapp_result["success"] else None,
+        "whatsapp_sent": False,
+        "whatsapp_queued": bool(customer_phone),
     }
 
 
+async def _send_and_log(
+    order_id: Optional[str],
+    phone: str,
+    customer_name: str,
+    order_number: str,
+    total: str,
+    currency: str,
+):
+    """Envía el WhatsApp de confirmación y registra el resultado (tarea de fondo)."""
+    try:
+        logger.info(f"📱 Enviando WhatsApp a {phone}...")
+        whatsapp_result = await send_order_confirmation(
+            phone=phone,
+            customer_name=customer_name,
+            order_number=order_number,
+            total=total,
+            currency=currency,
+        )
+        if whatsapp_result["success"]:
+            logger.info(f"✅ WhatsApp enviado. Message ID: {whatsapp_result['message_id']}")
+        else:
+            logger.warning(f"❌ WhatsApp falló: {whatsapp_result['error']}")
+
+        # Registrar resultado del WhatsApp
+        if order_id:
+            await mark_whatsapp_sent(
+                order_id=order_id,
+                success=whatsapp_result["success"],
+                message_id=whatsapp_result.get("message_id"),
+                error=whatsapp_result.get("error"),
+            )
+    except Exception:
+        logger.exception(f"❌ Error en el envío de WhatsApp del pedido {order_number}")
+
+
 @app.get("/orders")
-def list_orders(
+async def list_orders(
+    request: Request,
     status: Optional[str] = Query(None),
     whatsapp_sent: Optional[bool] = Query(None),
     limit: int = Query(50, ge=1, le=200),
-    offset: int = Query(0, ge=0),
+    cursor_created_at: Optional[datetime] = Query(None),
+    cursor_id: Optional[UUID] = Query(None),
 ):
-    """Lista pedidos del CRM con filtros opcionales."""
-    orders = get_orders(status=status, whatsapp_sent=whatsapp_sent, limit=limit, offset=offset)
-    return {"orders": orders, "count": len(orders)}
+    """
+    Lista pedidos del CRM con filtros opcionales.
+    Para la página siguiente, enviar los valores de next_cursor como
+    cursor_created_at / cursor_id (ambos o ninguno).
+    """
+    if (cursor_created_at is None) != (cursor_id is None):
+        missing = "cursor_id" if cursor_id is None else "cursor_created_at"
+        raise RequestValidationError([{
+            "type": "missing",
+            "loc": ("query", missing),
+            "msg": "cursor_created_at y cursor_id deben enviarse juntos",
+            "input": None,
+        }])
+    filters = make_order_filter(status or "", whatsapp_sent, limit)
+    page = await get_orders(
+        status=filters.status or None,
+        whatsapp_sent=filters.whatsapp_sent,
+        limit=filters.limit,
+        cursor_created_at=cursor_created_at,
+        cursor_id=cursor_id,
+    )
+    return etag_response(request, {
+        "orders": page["orders"],
+        "count": len(page["orders"]),
+        "next_cursor": page["next_cursor"],
+    })
 
 
 @app.get("/orders/{order_id}")
-def get_order(order_id: str):
+async def get_order(order_id: str, request: Request):
     """Detalle completo de un pedido con historial de WhatsApp."""
-    order = get_order_by_id(order_id)
+    order = await get_order_by_id(order_id)
     if not order:
         raise HTTPException(status_code=404, detail="Pedido no encontrado")
-    return order
+    return etag_response(request, order)
 
 
-@app.patch("/orders/{order_id}/status")
-def update_status(order_id: str, body: OrderStatusUpdate):
+@app.patch("/orders/{order_id}/status", openapi_extra=_json_body_schema(OrderStatusUpdate))
+async def update_status(order_id: str, request: Request):
     """Actualiza el estado de un pedido desde el CRM."""
-    valid_statuses = ["nuevo", "en_proceso", "enviado", "completado", "cancelado"]
-    if body.status not in valid_statuses:
-        raise HTTPException(
-            status_code=400,
-            detail=f"Estado inválido. Usa: {', '.join(valid_statuses)}",
-        )
-    updated = update_order_status(order_id, body.status, body.notes)
+    # El estado ya viene validado contra el Literal OrderStatus (422 si no es válido)
+    body = await validate_body(request, ORDER_STATUS_ADAPTER)
+    updated = await update_order_status(order_id, body.status, body.notes)
     if not updated:
         raise HTTPException(status_code=404, detail="Pedido no encontrado")
     return {"success": True, "order": updated}
 
 
 @app.post("/orders/{order_id}/resend-whatsapp")
-def resend_whatsapp(order_id: str):
+async def resend_whatsapp(order_id: str):
     """Reenvía manualmente el WhatsApp de confirmación para un pedido."""
-    order = get_order_by_id(order_id)
+    order = await get_order_by_id(order_id)
     if not order:
         raise HTTPException(status_code=404, detail="Pedido no encontrado")
 
+    # Solo se leen las columnas que usa el mensaje: no hace falta reconstruir
+    # el pedido (filas antiguas pueden traer precios en texto sin validar)
     phone = order.get("customer_phone")
     if not phone:
         raise HTTPException(status_code=400, detail="Este pedido no tiene teléfono registrado")
 
-    result = send_order_confirmation(
+    result = await send_order_confirmation(
         phone=phone,
-        customer_name=order.get("customer_name", "Cliente"),
-        order_number=order.get("order_number", ""),
-        total=order.get("total_price", "0"),
-        currency=order.get("currency", "COP"),
+        customer_name=order.get("customer_name") or "Cliente",
+        order_number=order.get("order_number") or "",
+        total=str(order.get("total_price") or "0"),
+        currency=order.get("currency") or "COP",
     )
 
-    mark_whatsapp_sent(
+    await mark_whatsapp_sent(
         order_id=order_id,
         success=result["success"],
         message_id=result.get("message_id"),
@@ -260,9 +486,9 @@ def resend_whatsapp(order_id: str):
 
 
 @app.get("/stats")
-def dashboard_stats():
+async def dashboard_stats():
     """Estadísticas del dashboard CRM."""
-    return get_dashboard_stats()
+    return await get_dashboard_stats()
 
 
 # ────────────────────────────────────────────────────
@@ -271,4 +497,14 @@ def dashboard_stats():
 if __name__ == "__main__":
     import uvicorn
     port = int(os.getenv("PORT", 8000))
-    uvicorn.run("main:app", host="0.0.0.0", port=port, reload=True)
+    # uvloop + httptools (C/Cython) y un worker por CPU. El access log de
+    # uvicorn se desactiva porque LogRequestsMiddleware ya registra cada petición.
+    uvicorn.run(
+        "main:app",
+        host="0.0.0.0",
+        port=port,
+        loop="uvloop",
+        http="httptools",
+        workers=int(os.getenv("WEB_CONCURRENCY", os.cpu_count() or 1)),
+        access_log=False,
+    )
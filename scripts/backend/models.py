@@ -1,34 +1,196 @@
 """
 models.py — Schemas Pydantic para validación de datos
+
+Límite de confianza:
+  - Entrada NO confiable (body crudo del webhook de Make, requests del CRM):
+    siempre ShopifyOrderPayload / adaptadores con validate_json (validación completa).
+  - Las filas ya guardadas en Supabase se usan como dicts (ver resend_whatsapp):
+    las anteriores a la validación de precios pueden traer texto no numérico.
 """
-from pydantic import BaseModel, EmailStr
-from typing import Optional, List
+import os
+import re
+import sys
+import pickle
+import pathlib
+from array import array
+from dataclasses import dataclass
+from decimal import Decimal
+from functools import cached_property, lru_cache
+from pydantic import BaseModel, ConfigDict, Field, TypeAdapter, field_validator
+from pydantic_core import SchemaSerializer, SchemaValidator, __version__ as _PYDANTIC_CORE_VERSION
+from typing import Optional, List, Dict, Any, Literal, Annotated, Mapping, Final
 from datetime import datetime
 
+# Valores cerrados: pydantic-core los valida con una búsqueda en un set prearmado
+FinancialStatus = Literal[
+    "pending", "authorized", "partially_paid", "paid",
+    "partially_refunded", "refunded", "voided", "expired",
+]
+FulfillmentStatus = Literal["fulfilled", "partial", "restocked", "unfulfilled"]
+OrderStatus = Literal["nuevo", "en_proceso", "enviado", "completado", "cancelado"]
+
+# Caché opcional de core schemas en disco (ver final del módulo). Con la caché
+# activa los modelos difieren la construcción del schema (defer_build) para
+# poder cargarlo ya compilado en vez de reconstruirlo en cada import/reload.
+_SCHEMA_CACHE_ENABLED = os.getenv("COPAS_SCHEMA_CACHE") == "1"
+
+# Cadenas de baja cardinalidad (moneda, estados) se internan al validar: el
+# código posterior puede comparar por identidad, p. ej. order.currency is INTERNED_COP
+INTERNED_COP: Final = sys.intern("COP")
+
+
+def _intern(v):
+    return sys.intern(v) if isinstance(v, str) else v
+
+
+# Config común: ignora campos extra de Shopify sin guardarlos, instancias
+# inmutables (hashables) y sin validar defaults (todos son constantes Final
+# precalculadas o literales ya válidos).
+_MODEL_CONFIG = ConfigDict(
+    extra="ignore",
+    frozen=True,
+    str_strip_whitespace=True,
+    validate_default=False,
+    defer_build=_SCHEMA_CACHE_ENABLED,
+)
+
+def _to_decimal(v):
+    # float → Decimal vía su repr para no arrastrar error binario (0.1 → "0.1").
+    # str / int / Decimal los parsea pydantic-core directamente.
+    if isinstance(v, float):
+        return Decimal(repr(v))
+    return v
+
+
+def _none_to_empty(v):
+    # Campos de texto opcionales: null y "" significan lo mismo → se guarda ""
+    return "" if v is None else v
+
+
+# Validación de email ligera (sin email-validator): un regex precompilado
+_EMAIL_RE = re.compile(r"^[^@\s]+@[^@\s]+\.[^@\s]+$")
+
 
 class CustomerData(BaseModel):
-    first_name: Optional[str] = None
-    last_name: Optional[str] = None
-    email: Optional[str] = None
-    phone: Optional[str] = None
+    model_config = _MODEL_CONFIG
+
+    first_name: str = ""
+    last_name: str = ""
+    email: str = ""
+    phone: str = ""
+
+    @field_validator("first_name", "last_name", "phone", mode="before")
+    @classmethod
+    def none_to_empty(cls, v):
+        return _none_to_empty(v)
+
+    @field_validator("email", mode="before")
+    @classmethod
+    def check_email(cls, v):
+        # Validador "before": corre antes de str_strip_whitespace, se recorta aquí
+        if isinstance(v, str):
+            v = v.strip()
+        # Make envía "" cuando Shopify no tiene email: se acepta igual que null
+        if not v:
+            return ""
+        if isinstance(v, str) and _EMAIL_RE.match(v):
+            return v
+        raise ValueError("Email inválido")
 
 
 class ShippingAddress(BaseModel):
-    address1: Optional[str] = None
-    address2: Optional[str] = None
-    city: Optional[str] = None
-    province: Optional[str] = None
-    country: Optional[str] = None
-    zip: Optional[str] = None
-    phone: Optional[str] = None  # Fallback si customer.phone está vacío
+    model_config = _MODEL_CONFIG
+
+    address1: str = ""
+    address2: str = ""
+    city: str = ""
+    province: str = ""
+    country: str = ""
+    zip: str = ""
+    phone: str = ""  # Fallback si customer.phone está vacío
+
+    @field_validator("*", mode="before")
+    @classmethod
+    def none_to_empty(cls, v):
+        return _none_to_empty(v)
+
+
+# Instancias vacías compartidas (inmutables) usadas como default en vez de None:
+# todos los pedidos sin cliente/dirección apuntan al mismo objeto.
+EMPTY_CUSTOMER: Final = CustomerData.model_construct()
+EMPTY_SHIPPING: Final = ShippingAddress.model_construct()
+
+
+# Los defaults que dependen de identidad se entregan con default_factory de
+# módulo: el pickle de la caché de schemas (ver final del módulo) guarda la
+# función por referencia y no una copia del objeto, así que la identidad se
+# mantiene también con COPAS_SCHEMA_CACHE=1.
+def _empty_customer() -> CustomerData:
+    return EMPTY_CUSTOMER
+
+
+def _empty_shipping() -> ShippingAddress:
+    return EMPTY_SHIPPING
+
+
+def _default_currency() -> str:
+    return INTERNED_COP
 
 
 class LineItem(BaseModel):
+    model_config = _MODEL_CONFIG
+
     name: str
-    quantity: int
-    price: str
-    sku: Optional[str] = None
-    variant_title: Optional[str] = None
+    # strict: int de JSON sin escalera de coerción; < 2**31 cabe en array("i")
+    quantity: Annotated[int, Field(gt=0, lt=2_147_483_647, strict=True)]
+    price: Decimal
+    sku: str = ""
+    variant_title: str = ""
+
+    @field_validator("sku", "variant_title", mode="before")
+    @classmethod
+    def none_to_empty(cls, v):
+        return _none_to_empty(v)
+
+    @field_validator("price", mode="before")
+    @classmethod
+    def parse_price(cls, v):
+        return _to_decimal(v)
+
+
+class LineItemsSoA:
+    """
+    Vista columnar (structure-of-arrays) de los line items de un pedido.
+    Las agregaciones recorren arrays contiguos (p. ej. quantities es un
+    array.array de C) en vez de saltar entre objetos LineItem.
+    """
+    __slots__ = ("names", "quantities", "prices", "skus")
+
+    def __init__(self, items: "tuple[LineItem, ...]"):
+        self.names: List[str] = [li.name for li in items]
+        self.quantities: array = array("i", [li.quantity for li in items])
+        self.prices: List[Decimal] = [li.price for li in items]
+        self.skus: List[str] = [li.sku for li in items]
+
+    def total_quantity(self) -> int:
+        return sum(self.quantities)
+
+    def subtotal(self) -> Decimal:
+        return sum(map(lambda p, q: p * q, self.prices, self.quantities), Decimal(0))
+
+
+@dataclass(slots=True, frozen=True)
+class OrderFlatView:
+    """
+    Vista plana de los campos de un pedido que usan el webhook y los reportes:
+    atributos directos, sin saltar por customer / shipping_address.
+    """
+    order_id: str
+    phone: str
+    customer_name: str
+    city: str
+    total: Decimal
+    line_count: int
 
 
 class ShopifyOrderPayload(BaseModel):
@@ -36,27 +198,203 @@ class ShopifyOrderPayload(BaseModel):
     Payload que Make enviará al endpoint /webhook/shopify
     Make debe mapear los campos del webhook de Shopify a este formato.
     """
+    model_config = _MODEL_CONFIG
+
     shopify_order_id: str
     order_number: str
-    customer: Optional[CustomerData] = None
-    shipping_address: Optional[ShippingAddress] = None
-    line_items: List[LineItem] = []
-    total_price: str
-    currency: str = "COP"
-    financial_status: Optional[str] = None   # paid, pending, etc.
-    fulfillment_status: Optional[str] = None  # null, fulfilled, etc.
-    note: Optional[str] = None
-    tags: Optional[str] = None
+    customer: CustomerData = Field(default_factory=_empty_customer)
+    shipping_address: ShippingAddress = Field(default_factory=_empty_shipping)
+    line_items: tuple[LineItem, ...] = ()  # inmutable, como el resto del pedido
+    total_price: Decimal  # parseado una sola vez al entrar (aritmética exacta en COP)
+    currency: str = Field(default_factory=_default_currency)
+    financial_status: Optional[FinancialStatus] = None
+    fulfillment_status: Optional[FulfillmentStatus] = None  # null = sin despachar
+    note: str = ""
+    tags: str = ""
+
+    @field_validator("note", "tags", mode="before")
+    @classmethod
+    def none_to_empty(cls, v):
+        return _none_to_empty(v)
+
+    @field_validator("customer", "shipping_address", mode="before")
+    @classmethod
+    def null_to_empty_model(cls, v, info):
+        # null desde Make → el singleton vacío (sin crear un modelo nuevo)
+        if v is None:
+            return EMPTY_CUSTOMER if info.field_name == "customer" else EMPTY_SHIPPING
+        return v
+
+    @field_validator("financial_status", "fulfillment_status", mode="before")
+    @classmethod
+    def empty_to_none(cls, v):
+        # Make envía "" cuando Shopify manda null
+        return None if v == "" else v
+
+    @field_validator("currency", "financial_status", "fulfillment_status", mode="after")
+    @classmethod
+    def intern_codes(cls, v):
+        return _intern(v)
+
+    @field_validator("total_price", mode="before")
+    @classmethod
+    def parse_total_price(cls, v):
+        return _to_decimal(v)
+
+    def to_flat(self) -> OrderFlatView:
+        customer = self.customer
+        shipping = self.shipping_address
+        return OrderFlatView(
+            order_id=self.shopify_order_id,
+            # Teléfono: customer.phone primero, luego shipping_address.phone
+            phone=customer.phone or shipping.phone or "",
+            customer_name=f"{customer.first_name} {customer.last_name}".strip() or "Cliente",
+            city=shipping.city,
+            total=self.total_price,
+            line_count=len(self.line_items),
+        )
+
+    @cached_property
+    def line_items_soa(self) -> LineItemsSoA:
+        """Vista columnar de line_items, construida una sola vez por pedido."""
+        return LineItemsSoA(self.line_items)
+
+    def model_copy(self, *, update: Optional[Mapping[str, Any]] = None, deep: bool = False):
+        # cached_property guarda la vista en __dict__ y model_copy lo copia:
+        # se descarta para que la copia no arrastre line items viejos
+        copy = super().model_copy(update=update, deep=deep)
+        copy.__dict__.pop("line_items_soa", None)
+        return copy
+
+    @classmethod
+    def ensure(cls, obj: Any) -> "ShopifyOrderPayload":
+        """
+        Devuelve obj tal cual si ya es un pedido validado (pasos en proceso);
+        cualquier otra cosa (dict del wire) pasa por el validador completo.
+        No usar revalidate_instances="always" en la config: anularía este atajo.
+        """
+        if type(obj) is cls:
+            return obj
+        return SHOPIFY_ORDER_ADAPTER.validate_python(obj)
+
+    @classmethod
+    def from_trusted(cls, d: Dict[str, Any]) -> "ShopifyOrderPayload":
+        """
+        Construye el pedido a partir de un dict ya normalizado por nosotros.
+        Pasa por validate_python: medido, es más rápido que armar el árbol
+        con model_construct en Python, y además valida.
+        """
+        return SHOPIFY_ORDER_ADAPTER.validate_python(d)
 
 
 class OrderStatusUpdate(BaseModel):
     """Para actualizar el estado de un pedido desde el CRM"""
-    status: str  # nuevo, en_proceso, enviado, completado, cancelado
+    model_config = _MODEL_CONFIG
+
+    status: OrderStatus
     notes: Optional[str] = None
 
+    @field_validator("status", mode="after")
+    @classmethod
+    def intern_status(cls, v):
+        return _intern(v)
+
 
 class OrderFilter(BaseModel):
-    status: Optional[str] = None
+    """Filtros de GET /orders (mismos límites que sus Query params)."""
+    model_config = _MODEL_CONFIG
+
+    status: str = ""
     whatsapp_sent: Optional[bool] = None
-    limit: int = 50
-    offset: int = 0
+    limit: Annotated[int, Field(ge=1, le=200, strict=True)] = 50
+
+
+@lru_cache(maxsize=512)
+def make_order_filter(
+    status: str = "",
+    whatsapp_sent: Optional[bool] = None,
+    limit: int = 50,
+) -> OrderFilter:
+    """
+    OrderFilter memoizado para combinaciones repetidas (dashboards que
+    refrescan). Solo lo llama list_orders, cuyos Query params ya validan los
+    mismos límites, así que se construye sin revalidar; al ser frozen, la
+    instancia compartida es segura entre peticiones. El cursor de paginación
+    queda fuera: cambia en cada página y solo ensuciaría la caché.
+    """
+    return OrderFilter.model_construct(status=status, whatsapp_sent=whatsapp_sent, limit=limit)
+
+
+# ────────────────────────────────────────────────────
+# Caché de core schemas (COPAS_SCHEMA_CACHE=1)
+#
+# El primer import guarda los schemas compilados en models.schemas.pkl; los
+# siguientes (uvicorn --reload, workers nuevos) los cargan y crean los
+# validadores directamente, sin recorrer las anotaciones. La caché se invalida
+# si models.py es más nuevo o cambia la versión de pydantic-core.
+# ────────────────────────────────────────────────────
+_SCHEMA_MODELS = (
+    CustomerData,
+    ShippingAddress,
+    LineItem,
+    ShopifyOrderPayload,
+    OrderStatusUpdate,
+    OrderFilter,
+)
+_SCHEMA_CACHE_PATH = pathlib.Path(__file__).with_suffix(".schemas.pkl")
+
+
+def _load_schema_cache() -> bool:
+    try:
+        if _SCHEMA_CACHE_PATH.stat().st_mtime <= pathlib.Path(__file__).stat().st_mtime:
+            return False
+        with _SCHEMA_CACHE_PATH.open("rb") as f:
+            cached = pickle.load(f)
+        if cached.get("__pydantic_core__") != _PYDANTIC_CORE_VERSION:
+            return False
+        for model in _SCHEMA_MODELS:
+            schema = cached[model.__name__]
+            model.__pydantic_core_schema__ = schema
+            model.__pydantic_validator__ = SchemaValidator(schema)
+            model.__pydantic_serializer__ = SchemaSerializer(schema)
+            model.__pydantic_complete__ = True
+        return True
+    except Exception:
+        # Caché ausente, corrupta o incompatible: se reconstruye normalmente
+        return False
+
+
+def _write_schema_cache() -> None:
+    for model in _SCHEMA_MODELS:
+        model.model_rebuild()
+    cached = {model.__name__: model.__pydantic_core_schema__ for model in _SCHEMA_MODELS}
+    cached["__pydantic_core__"] = _PYDANTIC_CORE_VERSION
+    # Escritura atómica: varios workers importan a la vez, así que cada uno
+    # escribe su propio temporal y lo renombra; nadie lee un pickle a medias.
+    tmp = _SCHEMA_CACHE_PATH.with_name(f"{_SCHEMA_CACHE_PATH.name}.{os.getpid()}.tmp")
+    try:
+        with tmp.open("wb") as f:
+            pickle.dump(cached, f)
+        os.replace(tmp, _SCHEMA_CACHE_PATH)
+    except (OSError, pickle.PicklingError, TypeError, AttributeError):
+        # Sistema de archivos de solo lectura (serverless) o schema no serializable
+        try:
+            tmp.unlink(missing_ok=True)
+        except OSError:
+            pass
+
+
+if _SCHEMA_CACHE_ENABLED and not _load_schema_cache():
+    _write_schema_cache()
+
+
+# ────────────────────────────────────────────────────
+# Adaptadores reutilizables (el core schema se construye una sola vez)
+#
+# Los endpoints deben validar los bytes crudos del body con
+# ADAPTER.validate_json(raw) — sin json.loads previo — para que pydantic-core
+# parsee y valide en una sola pasada.
+# ────────────────────────────────────────────────────
+SHOPIFY_ORDER_ADAPTER = TypeAdapter(ShopifyOrderPayload)
+SHOPIFY_ORDER_LIST_ADAPTER = TypeAdapter(List[ShopifyOrderPayload])
+ORDER_STATUS_ADAPTER = TypeAdapter(OrderStatusUpdate)
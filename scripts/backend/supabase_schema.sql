@@ -108,6 +108,28 @@ CREATE TRIGGER trigger_customers_updated_at
     BEFORE UPDATE ON customers
     FOR EACH ROW EXECUTE FUNCTION update_updated_at();
 
+-- ────────────────────────────────────────────────────
+-- RPC: registrar resultado de WhatsApp en una sola transacción
+-- Actualiza el pedido e inserta el log (POST /rest/v1/rpc/log_whatsapp_result)
+-- ────────────────────────────────────────────────────
+CREATE OR REPLACE FUNCTION log_whatsapp_result(
+    p_order_id    UUID,
+    p_success     BOOLEAN,
+    p_message_id  TEXT DEFAULT NULL,
+    p_error       TEXT DEFAULT NULL
+)
+RETURNS VOID AS $$
+BEGIN
+    UPDATE orders
+       SET whatsapp_sent    = p_success,
+           whatsapp_sent_at = CASE WHEN p_success THEN NOW() ELSE whatsapp_sent_at END
+     WHERE id = p_order_id;
+
+    INSERT INTO whatsapp_logs (order_id, success, message_id, error_message)
+    VALUES (p_order_id, p_success, p_message_id, p_error);
+END;
+$$ LANGUAGE plpgsql;
+
 -- ────────────────────────────────────────────────────
 -- Row Level Security (RLS) — Desactivado para uso con Service Key
 -- El backend usa SUPABASE_SERVICE_KEY que bypasea RLS
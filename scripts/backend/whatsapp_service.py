@@ -5,6 +5,7 @@ Documentación: https://developers.facebook.com/docs/whatsapp/cloud-api
 """
 import os
 import httpx
+import orjson
 from dotenv import load_dotenv
 from typing import Optional, Dict, Any
 
@@ -16,6 +17,69 @@ ACCESS_TOKEN = os.getenv("WHATSAPP_ACCESS_TOKEN", "")
 TEMPLATE_NAME = os.getenv("WHATSAPP_TEMPLATE_NAME", "order_confirmation")
 TEMPLATE_LANGUAGE = os.getenv("WHATSAPP_TEMPLATE_LANGUAGE", "es")
 
+# Cliente compartido: reutiliza conexiones TLS entre mensajes y, con HTTP/2,
+# multiplexa envíos concurrentes sobre una sola conexión con graph.facebook.com.
+# Se crea y se cierra en el lifespan de la app (ver main.py); _get_client lo
+# crea al primer uso si la app se sirve sin lifespan.
+_client: Optional[httpx.AsyncClient] = None
+
+
+def _get_client() -> httpx.AsyncClient:
+    global _client
+    if _client is None:
+        _client = httpx.AsyncClient(
+            base_url=WHATSAPP_API_URL,
+            headers={
+                "Authorization": f"Bearer {ACCESS_TOKEN}",
+                "Content-Type": "application/json",
+            },
+            timeout=30.0,
+            http2=True,
+            limits=httpx.Limits(max_keepalive_connections=10, max_connections=20),
+        )
+    return _client
+
+
+async def init_client() -> None:
+    _get_client()
+
+
+_MESSAGES_PATH = f"/{PHONE_NUMBER_ID}/messages"
+
+# Partes fijas del mensaje de plantilla, construidas una sola vez.
+# Se comparten entre llamadas: no deben mutarse.
+_TEMPLATE_SKELETON: Dict[str, Any] = {"messaging_product": "whatsapp", "type": "template"}
+_TEMPLATE_STATIC: Dict[str, Any] = {
+    "name": TEMPLATE_NAME,
+    "language": {"code": TEMPLATE_LANGUAGE},
+}
+
+
+# Timeout corto: si la red hacia el servicio está lenta o bloqueada, el worker
+# no debe demorar su arranque; la primera petición real abrirá la conexión.
+_WARM_UP_TIMEOUT = 2.0
+
+
+async def warm_up() -> None:
+    """Abre la conexión TLS con Meta antes del primer mensaje real."""
+    if not PHONE_NUMBER_ID or not ACCESS_TOKEN:
+        return
+    try:
+        await _get_client().head("/", timeout=_WARM_UP_TIMEOUT)
+    except httpx.HTTPError:
+        pass
+
+
+async def close_client() -> None:
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+
+
+# Tabla de borrado para str.translate: elimina todo lo que no sea dígito (Latin-1)
+_PHONE_TRANS = str.maketrans("", "", "".join(chr(c) for c in range(256) if not chr(c).isdigit()))
+
 
 def normalize_phone(phone: str) -> str:
     """
@@ -26,21 +90,20 @@ def normalize_phone(phone: str) -> str:
       3001234567        → 573001234567 (asume Colombia por defecto)
       +1-555-123-4567   → 15551234567
     """
-    # Remover caracteres no numéricos excepto '+'
-    cleaned = "".join(c for c in phone if c.isdigit() or c == "+")
-
-    # Remover el '+' si está al inicio
-    if cleaned.startswith("+"):
-        cleaned = cleaned[1:]
+    # Remover caracteres no numéricos (incluido el '+') en una sola pasada en C
+    cleaned = phone.translate(_PHONE_TRANS)
+    if cleaned and not cleaned.isdigit():
+        # Caracteres fuera de Latin-1 (raro): filtrado carácter a carácter
+        cleaned = "".join(c for c in cleaned if c.isdigit())
 
     # Si es un número colombiano sin código de país (10 dígitos empezando en 3)
-    if len(cleaned) == 10 and cleaned.startswith("3"):
+    if len(cleaned) == 10 and cleaned[0] == "3":
         cleaned = "57" + cleaned
 
     return cleaned
 
 
-def send_order_confirmation(
+async def send_order_confirmation(
     phone: str,
     customer_name: str,
     order_number: str,
@@ -78,13 +141,12 @@ def send_order_confirmation(
     # Formatear total
     total_formatted = f"{currency} {total}"
 
+    # Solo se construye la parte variable; el resto sale del esqueleto compartido
     payload = {
-        "messaging_product": "whatsapp",
+        **_TEMPLATE_SKELETON,
         "to": normalized,
-        "type": "template",
         "template": {
-            "name": TEMPLATE_NAME,
-            "language": {"code": TEMPLATE_LANGUAGE},
+            **_TEMPLATE_STATIC,
             "components": [
                 {
                     "type": "body",
@@ -99,32 +161,27 @@ def send_order_confirmation(
     }
 
     try:
-        with httpx.Client(timeout=30.0) as client:
-            response = client.post(
-                f"{WHATSAPP_API_URL}/{PHONE_NUMBER_ID}/messages",
-                headers={
-                    "Authorization": f"Bearer {ACCESS_TOKEN}",
-                    "Content-Type": "application/json",
-                },
-                json=payload,
-            )
-            response.raise_for_status()
-            data = response.json()
-
-            message_id = None
-            if "messages" in data and data["messages"]:
-                message_id = data["messages"][0].get("id")
-
-            return {
-                "success": True,
-                "message_id": message_id,
-                "error": None,
-            }
+        response = await _get_client().post(
+            _MESSAGES_PATH,
+            content=orjson.dumps(payload),
+        )
+        response.raise_for_status()
+        data = orjson.loads(response.content)
+
+        message_id = None
+        if "messages" in data and data["messages"]:
+            message_id = data["messages"][0].get("id")
+
+        return {
+            "success": True,
+            "message_id": message_id,
+            "error": None,
+        }
 
     except httpx.HTTPStatusError as e:
         error_detail = ""
         try:
-            error_detail = e.response.json().get("error", {}).get("message", str(e))
+            error_detail = orjson.loads(e.response.content).get("error", {}).get("message", str(e))
         except Exception:
             error_detail = str(e)
         return {
@@ -140,7 +197,7 @@ def send_order_confirmation(
         }
 
 
-def send_custom_message(phone: str, message_text: str) -> Dict[str, Any]:
+async def send_custom_message(phone: str, message_text: str) -> Dict[str, Any]:
     """
     Envía un mensaje de texto libre (solo funciona dentro de la ventana de 24h
     después de que el cliente te haya escrito primero).
@@ -158,16 +215,11 @@ def send_custom_message(phone: str, message_text: str) -> Dict[str, Any]:
     }
 
     try:
-        with httpx.Client(timeout=30.0) as client:
-            response = client.post(
-                f"{WHATSAPP_API_URL}/{PHONE_NUMBER_ID}/messages",
-                headers={
-                    "Authorization": f"Bearer {ACCESS_TOKEN}",
-                    "Content-Type": "application/json",
-                },
-                json=payload,
-            )
-            response.raise_for_status()
-            return {"success": True, "error": None}
+        response = await _get_client().post(
+            _MESSAGES_PATH,
+            content=orjson.dumps(payload),
+        )
+        response.raise_for_status()
+        return {"success": True, "error": None}
     except Exception as e:
         return {"success": False, "error": str(e)}